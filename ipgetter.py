@@ -35,10 +35,19 @@ import ssl
 import json
 import os 
 import six
+import time
+import tempfile
+import stat
+import getpass
 
 from datetime import datetime, timedelta
 from sys      import exc_info
 
+try:
+    import fcntl
+except ImportError: # no flock() on this platform, run without cross-process locking
+    fcntl = None
+
 if six.PY3:
     import urllib.request   as urllib
     import http.cookiejar   as cjar
@@ -51,13 +60,367 @@ __version__ = "0.7"
 IPV4_REGEX_STRING = ''
 for octet in range(4):
     IPV4_REGEX_STRING += '{0}(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)'.format('\.' if octet > 0 else '')
-    
 
-def myip():
-    return IPgetter().get_externalip()
+LOOKUP_CACHE_FILENAME    = None # None = lookupCache.json in a private, per-user directory under the system temp directory
+LOOKUP_CACHE_TTL         = 60   # seconds a fetched IP is reused by every process on the host (0 = off)
+LOOKUP_LOCK_TIMEOUT      = 10   # seconds to wait for another process's lock before giving up on this lookup
+LOOKUP_INFLIGHT_TIMEOUT  = 5    # seconds other processes wait on one process's fetch before fetching themselves
+SERVER_RATE_LIMIT        = 2    # average requests per minute (and burst size) for any one server, shared by every process on the host (0 = off)
+
+
+def myip(cache_ttl = LOOKUP_CACHE_TTL, rate_limit = SERVER_RATE_LIMIT, use_cache = True):
+    return IPgetter(cache_ttl = cache_ttl, rate_limit = rate_limit).get_externalip(use_cache = use_cache)
+
+def myipAndSource(cache_ttl = LOOKUP_CACHE_TTL, rate_limit = SERVER_RATE_LIMIT, use_cache = True):
+    return IPgetter(cache_ttl = cache_ttl, rate_limit = rate_limit).get_externalip_and_source(use_cache = use_cache)
+
+def default_cache_filename():
+    '''
+    Returns the per-user lookup cache file, creating its (mode 0700) directory if need be
+    '''
+    if hasattr(os, 'getuid'):
+        owner = str(os.getuid())
+    else:
+        owner = getpass.getuser()
+    dirname = os.path.join(tempfile.gettempdir(), 'ipgetter-' + owner)
+    try:
+        os.mkdir(dirname, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(dirname)
+    if not stat.S_ISDIR(st.st_mode):
+        raise OSError("lookup cache directory '%s' is not a directory" % dirname)
+    check_owner(st, dirname)
+    return os.path.join(dirname, 'lookupCache.json')
+
+def check_owner(st, filename):
+    '''
+    Refuses files belonging to someone else, they could hold a forged lookup
+    '''
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        raise PermissionError("'%s' is not owned by the current user" % filename)
+
+def open_private(filename, flags):
+    '''
+    Opens filename (creating it mode 0600) without following symlinks and checks we own it
+    '''
+    fd = os.open(filename, flags | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+    try:
+        check_owner(os.fstat(fd), filename)
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+def isNumber(val):
+    return isinstance(val, (int, float)) and not isinstance(val, bool)
+
 
-def myipAndSource():
-    return IPgetter().get_externalip_and_source()
+def _testLookupWorker(filename):
+    cache          = LookupCache(filename = filename, ttl = 60, rate_limit = 0)
+    cached, server = cache.acquire(['test'])
+    if cached is not None or server is None:
+        return 0
+    time.sleep(0.2) # pretend to fetch, without holding the lock
+    cache.finish(dict(ip = '8.8.8.8', server = server))
+    return 1
+
+def _testBucketWorker(filename):
+    cache          = LookupCache(filename = filename, ttl = 0, rate_limit = 60)
+    cached, server = cache.acquire(['a'], use_cache = False)
+    granted        = time.time()
+    cache.finish(None)
+    return granted
+
+
+class LookupCache(object):
+
+    '''
+    This class holds state shared by every ipgetter process of the same user
+    on the host: the most recent good lookup, a token bucket for each server
+    and a marker for a fetch that is in progress. The state lives in a private
+    JSON file guarded by an exclusive flock(), which is only held long enough
+    to read and update the state, never across a fetch. Processes fired in the
+    same cron minute wait for the first one's fetch and reuse its answer
+    instead of hitting the servers again.
+
+    If the file can't be used at all, state is left as None and lookups go
+    ahead uncached and unthrottled as they did before the cache existed. If
+    another process holds the lock past LOOKUP_LOCK_TIMEOUT, busy is set and
+    no request is sent, the rate limit is never bypassed.
+    '''
+
+    def __init__(self, filename = LOOKUP_CACHE_FILENAME, ttl = LOOKUP_CACHE_TTL, rate_limit = SERVER_RATE_LIMIT, lock_timeout = LOOKUP_LOCK_TIMEOUT):
+        self.filename     = filename
+        self.ttl          = float(ttl)
+        self.rate_limit   = float(rate_limit)
+        self.lock_timeout = float(lock_timeout)
+        self.owner        = '%d:%d' % (os.getpid(), id(self))
+        self.state        = None
+        self.busy         = False
+        self.lockfd       = None
+
+    def __enter__(self):
+        self.lock()
+        return self
+
+    def __exit__(self, *args):
+        self.unlock()
+
+    def lock(self):
+        self.busy = False
+        try:
+            if self.filename is None:
+                self.filename = default_cache_filename()
+            self.lockfd = open_private(self.filename + '.lock', os.O_RDWR)
+            if fcntl is not None:
+                deadline = time.time() + self.lock_timeout
+                while True:
+                    try:
+                        fcntl.flock(self.lockfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.time() >= deadline:
+                            self.busy = True
+                            raise
+                        time.sleep(0.1)
+            self.state = self.read()
+        except OSError:
+            t, v, tb = exc_info()
+            print ("Lookup cache unavailable: %s" % v)
+            self.release()
+
+    def unlock(self):
+        if self.state is not None:
+            try:
+                self.write()
+            except OSError:
+                t, v, tb = exc_info()
+                print ("Unable to save lookup cache: %s" % v)
+        self.release()
+
+    def release(self):
+        self.state = None
+        if self.lockfd is not None:
+            os.close(self.lockfd) # closing drops the flock()
+            self.lockfd = None
+
+    def read(self):
+        state = None
+        try:
+            with os.fdopen(open_private(self.filename, os.O_RDONLY), 'r') as infile:
+                state = json.load(infile)
+        except ValueError:
+            pass
+        if (not isinstance(state, dict)
+         or not isinstance(state.get("lookup"), dict)
+         or not isinstance(state.get("buckets"), dict)
+           ): # missing or mangled, start afresh
+            state = dict (lookup  = {}
+                         ,buckets = {}
+                         )
+        # drop anything mangled, an empty lookup is a miss and a missing bucket counts as full
+        lookup = state["lookup"]
+        if (not isinstance(lookup.get("ip"), str)
+         or not isNumber(lookup.get("timestamp"))
+         or not isinstance(lookup.get("server"), (str, type(None)))
+           ):
+            state["lookup"] = {}
+        state["buckets"] = dict ((server, bucket) for server, bucket in state["buckets"].items()
+                                 if isinstance(bucket, dict)
+                                and isNumber(bucket.get("tokens"))
+                                and isNumber(bucket.get("updated"))
+                                )
+        inflight = state.get("inflight")
+        if (not isinstance(inflight, dict)
+         or not isinstance(inflight.get("owner"), str)
+         or not isNumber(inflight.get("deadline"))
+           ):
+            state.pop("inflight", None)
+        return state
+
+    def write(self):
+        tmpFilename = self.filename + '.tmp'
+        with os.fdopen(open_private(tmpFilename, os.O_WRONLY | os.O_TRUNC), 'w') as outfile:
+            json.dump(self.state, outfile, indent=4)
+        os.replace(tmpFilename, self.filename)
+
+    def get_lookup(self):
+        '''
+        Returns the cached lookup if it is younger than the TTL, otherwise None
+        '''
+        if self.state is None:
+            return None
+        lookup = self.state["lookup"]
+        if (self.ttl <= 0
+         or not lookup.get("ip")
+         or lookup["timestamp"] + self.ttl < time.time()
+           ):
+            return None
+        return dict (ip     = lookup["ip"]
+                    ,server = lookup.get("server")
+                    )
+
+    def put_lookup(self, myip):
+        if self.state is None:
+            return
+        self.state["lookup"] = dict (ip        = myip["ip"]
+                                    ,server    = myip["server"]
+                                    ,timestamp = time.time()
+                                    )
+
+    def pending(self, now):
+        '''
+        Returns how long another process's fetch may still take, 0 if there is none
+        '''
+        inflight = self.state.get("inflight")
+        if inflight is None or inflight["owner"] == self.owner:
+            return 0.0
+        return max(inflight["deadline"] - now, 0.0)
+
+    def tokens(self, server, now):
+        '''
+        Returns how many tokens the server's bucket holds at time "now"
+        '''
+        capacity = max(self.rate_limit, 1.0)
+        bucket   = self.state["buckets"].get(server)
+        try:
+            elapsed = max(now - bucket["updated"], 0.0)
+            return min(capacity, bucket["tokens"] + elapsed * self.rate_limit / 60.0)
+        except (KeyError, TypeError):
+            return capacity
+
+    def take(self, servers, now):
+        '''
+        Takes a token from a random server that has one and returns (server, 0).
+        If every bucket is empty it returns (None, seconds until the first one refills).
+        '''
+        if self.rate_limit <= 0:
+            return random.choice(servers), 0.0
+        available = [s for s in servers if self.tokens(s, now) >= 1.0]
+        if len(available) == 0:
+            return None, max(min((1.0 - self.tokens(s, now)) * 60.0 / self.rate_limit for s in servers), 0.01)
+        server = random.choice(available)
+        self.state["buckets"][server] = dict (tokens  = self.tokens(server, now) - 1.0
+                                             ,updated = now
+                                             )
+        return server, 0.0
+
+    def acquire(self, servers, use_cache = True, validator = None):
+        '''
+        Returns (cached lookup, None) if a recent lookup passing validator is available,
+        otherwise (None, server) once a token for server has been taken.
+        The lock is let go while waiting for a refill or for another process's fetch,
+        and everything is checked again once it is back.
+        Returns (None, None) if another process holds the lock for too long.
+        '''
+        while True:
+            with self:
+                if self.busy:
+                    return None, None
+                if self.state is None: # cache unusable, pick a server as if it didn't exist
+                    return None, random.choice(servers)
+                now  = time.time()
+                wait = 0.0
+                if use_cache:
+                    cached = self.get_lookup()
+                    if cached is not None and (validator is None or validator(cached["ip"])):
+                        return cached, None
+                    wait = min(self.pending(now), 0.2)
+                if wait <= 0:
+                    server, wait = self.take(servers, now)
+                    if server is not None:
+                        self.state["inflight"] = dict (owner    = self.owner
+                                                      ,deadline = now + LOOKUP_INFLIGHT_TIMEOUT
+                                                      )
+                        return None, server
+            time.sleep(wait)
+
+    def finish(self, myip):
+        '''
+        Records a good lookup (or None after a failed fetch) and clears this process's in-flight marker
+        '''
+        with self:
+            if self.state is None:
+                return
+            if myip is not None:
+                self.put_lookup(myip)
+            inflight = self.state.get("inflight")
+            if inflight is not None and inflight["owner"] == self.owner:
+                del self.state["inflight"]
+
+    @staticmethod
+    def test():
+        '''
+        This function checks the cache in a scratch directory:
+        TTL expiry, token bucket refill and wait, recovery from a mangled
+        file, lock timeouts and several processes sharing one lookup
+        and one bucket.
+        '''
+        import multiprocessing
+
+        results  = []
+        def check (name, passed):
+            results.append(passed)
+            print('{0} : {1}'.format('PASS' if passed else 'FAIL', name))
+
+        tmpdir   = tempfile.mkdtemp(prefix='ipgetter-test-')
+        filename = os.path.join(tmpdir, 'lookupCache.json')
+        try:
+            with LookupCache(filename = filename, ttl = 1) as cache:
+                cache.put_lookup(dict(ip = '8.8.8.8', server = 'test'))
+            with LookupCache(filename = filename, ttl = 1) as cache:
+                check('lookup is reused within the TTL', cache.get_lookup() == dict(ip = '8.8.8.8', server = 'test'))
+            time.sleep(1.1)
+            with LookupCache(filename = filename, ttl = 1) as cache:
+                check('lookup expires after the TTL', cache.get_lookup() is None)
+
+            cache = LookupCache(filename = filename, rate_limit = 60)
+            start = time.time()
+            for i in range(60):
+                cache.acquire(['a'], use_cache = False)
+            check('full bucket gives a burst of rate_limit requests', time.time() - start < 1.0)
+            cache.acquire(['a'], use_cache = False)
+            check('empty bucket waits for a refill', 0.8 < time.time() - start < 2.5)
+            check('busy server is skipped', cache.acquire(['a', 'b'], use_cache = False) == (None, 'b'))
+            cache.finish(None)
+
+            with open(filename, 'w') as outfile:
+                outfile.write('{"lookup": {"ip": 5, "timestamp": %f}, "buckets": {"a": 5, "b": {"tokens": "x"}, "c": {"tokens": 0}}, "inflight": 7}' % time.time())
+            with LookupCache(filename = filename) as cache:
+                check('mangled state is recovered', cache.get_lookup() is None and cache.state["buckets"] == {}
+                                                   and "inflight" not in cache.state
+                                                   and cache.take(['a', 'b', 'c'], time.time())[0] in ['a', 'b', 'c'])
+
+            with LookupCache(filename = os.path.join(tmpdir, 'missing', 'x.json')) as cache:
+                check('unusable file falls back to no cache', cache.state is None and not cache.busy)
+
+            if fcntl is not None:
+                lockfd = os.open(filename + '.lock', os.O_RDWR)
+                fcntl.flock(lockfd, fcntl.LOCK_EX)
+                cache  = LookupCache(filename = filename, lock_timeout = 0.5)
+                check('held lock times out without sending a request', cache.acquire(['a']) == (None, None) and cache.busy)
+                os.close(lockfd)
+
+            os.remove(filename)
+            pool    = multiprocessing.Pool(4)
+            fetches = sum(pool.map(_testLookupWorker, [filename] * 4))
+            check('concurrent processes share one lookup', fetches == 1)
+
+            with LookupCache(filename = filename, rate_limit = 60) as cache:
+                start = time.time()
+                cache.state["buckets"]["a"] = dict (tokens = 0.0, updated = start)
+            granted = sorted(pool.map(_testBucketWorker, [filename] * 3))
+            pool.close()
+            pool.join()
+            check('waiting processes get one request per refill', granted[0] - start > 0.8
+                                                                 and granted[1] - granted[0] > 0.8
+                                                                 and granted[2] - granted[1] > 0.8)
+        finally:
+            for name in os.listdir(tmpdir):
+                os.remove(os.path.join(tmpdir, name))
+            os.rmdir(tmpdir)
+        print('\n{0} of {1} checks passed'.format(sum(results), len(results)))
 
 
 class IPgetter(object):
@@ -69,7 +432,7 @@ class IPgetter(object):
     on a single server
     '''
 
-    def __init__(self):
+    def __init__(self, cache_ttl = LOOKUP_CACHE_TTL, rate_limit = SERVER_RATE_LIMIT, cache_filename = LOOKUP_CACHE_FILENAME, validator = None):
         
         JSON_LIST_URL = "https://raw.githubusercontent.com/begleysm/ipwatch/master/servers.json"
         JSON_FILENAME = 'serverCache.json'
@@ -135,27 +498,40 @@ class IPgetter(object):
             else:
                 print("Error receiving data", operUrl.getcode())
         self.server_list = theList["servers"]
+        self.cache       = LookupCache(filename = cache_filename, ttl = cache_ttl, rate_limit = rate_limit)
+        self.validator   = validator # optional callable, only IPs it accepts are shared through the cache
         theList = None
 
-    def get_externalip(self):
+    def get_externalip(self, use_cache = True):
         '''
         This function gets your IP from a random server
         '''
-        return (self.get_externalip_and_source())["ip"]
+        return (self.get_externalip_and_source(use_cache = use_cache))["ip"]
 
-    def get_externalip_and_source(self):
+    def get_externalip_and_source(self, use_cache = True):
         '''
-        This function gets your IP from a random server, it also returns which server that was
+        This function gets your IP from a random server, it also returns which server that was.
+        A recent answer from any process on this host is reused unless use_cache is False.
         '''
+        def isGood (ip):
+            return self.validator is None or self.validator(ip)
+
         myip = dict (ip     = None
                     ,server = None
                     )
         #myip = ''
         for i in range(7):
-            myip["server"] = random.choice(self.server_list)
+            cached, myip["server"] = self.cache.acquire(self.server_list, use_cache = use_cache, validator = isGood)
+            if cached is not None:
+                return cached
+            if myip["server"] is None: # the cache is locked up, don't go round the rate limit
+                myip["ip"] = ''
+                break
             myip["ip"]     = self.fetch(myip["server"])
             if myip["ip"] is not None and len(myip["ip"]) > 0:
+                self.cache.finish(myip if isGood(myip["ip"]) else None)
                 break
+            self.cache.finish(None)
         return myip
 
     def fetch(self, server):
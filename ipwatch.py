@@ -48,6 +48,9 @@ class ConfigInfo:
     save_ip_path      = ""
     try_count         = ""
     ip_blacklist      = []
+    lookup_cache_ttl  = ""
+    server_rate_limit = ""
+    lookup_cache_path = ""
 
     def __init__(self):
         self.sender          = ""
@@ -65,6 +68,9 @@ class ConfigInfo:
         self.save_ip_path    = ""
         self.try_count       = ""
         self.ip_blacklist    = []
+        self.lookup_cache_ttl  = ""
+        self.server_rate_limit = ""
+        self.lookup_cache_path = ""
 
     def __str__(self):
         # this handles "print(obj)" for us
@@ -74,7 +80,7 @@ class ConfigInfo:
                 if type(val) in [int,bool]:
                     val = str(val)
                 if len(val) > 0:
-                    line = tag.ljust(16)+" : "
+                    line = tag.ljust(17)+" : "
                     if type(val) == list:
                         line += ','.join(val)
                     else:
@@ -112,6 +118,8 @@ class ConfigInfo:
         self.machine      = nvl(self.machine,socket.gethostname())
         self.subject_line = nvl(self.subject_line,"My IP Has Changed!")
         self.ip_blacklist = nvl(self.ip_blacklist,[])
+        self.lookup_cache_ttl  = nvl(str(self.lookup_cache_ttl),str(ipgetter.LOOKUP_CACHE_TTL))
+        self.server_rate_limit = nvl(str(self.server_rate_limit),str(ipgetter.SERVER_RATE_LIMIT))
 
         # if the list of receiver names is not the same length as the list of emails, then default the lot
         if len(self.receiver) is None or len(self.receiver) != len(self.receiver_email):
@@ -137,6 +145,15 @@ class ConfigInfo:
         except ValueError:
             raise ValueError("TRY_COUNT must be a positive integer")
 
+        # make sure the lookup cache TTL and server rate limit are non-negative integers
+        for thisValue, thisName in [(self.lookup_cache_ttl, "LOOKUP_CACHE_TTL"), (self.server_rate_limit, "SERVER_RATE_LIMIT")]:
+            try:
+                dummy = int(thisValue)
+                if dummy < 0:
+                    raise ValueError
+            except ValueError:
+                raise ValueError("%s must be a non-negative integer" % thisName)
+
         # make sure the entries in the IP blacklists are valid
         for thisIP in self.ip_blacklist:
             if not is_valid_ip(thisIP):
@@ -235,6 +252,12 @@ def readconfig(filepath,  configObj):
                 configObj.try_count = value
             elif (param == "ip_blacklist"):
                 configObj.ip_blacklist = value.split(',')
+            elif (param == "lookup_cache_ttl"):
+                configObj.lookup_cache_ttl = value
+            elif (param == "server_rate_limit"):
+                configObj.server_rate_limit = value
+            elif (param == "lookup_cache_path"):
+                configObj.lookup_cache_path = value
             else:
                 print ("ERROR: unexpected line found in config file: %s" % line)
 
@@ -244,18 +267,24 @@ def readconfig(filepath,  configObj):
     print (configObj)
 
 #return the current external IP address
-def getip(try_count, blacklist):
+def getip(try_count, blacklist, cache_ttl = ipgetter.LOOKUP_CACHE_TTL, rate_limit = ipgetter.SERVER_RATE_LIMIT, cache_path = ipgetter.LOOKUP_CACHE_FILENAME):
     "Function to return the current, external, IP address"
-    return (getipAndSource(try_count, blacklist))["ip"]
+    return (getipAndSource(try_count, blacklist, cache_ttl, rate_limit, cache_path))["ip"]
 
 #return the current external IP address
-def getipAndSource(try_count, blacklist):
+def getipAndSource(try_count, blacklist, cache_ttl = ipgetter.LOOKUP_CACHE_TTL, rate_limit = ipgetter.SERVER_RATE_LIMIT, cache_path = ipgetter.LOOKUP_CACHE_FILENAME):
     "Function to return the current, external, IP address and the site from which that info was retrieved"
     
+    getter = ipgetter.IPgetter(cache_ttl      = cache_ttl
+                              ,rate_limit     = rate_limit
+                              ,cache_filename = cache_path
+                              ,validator      = lambda ip: is_valid_ip(ip) and ip not in blacklist
+                              )
+
     #try up to config.try_count servers for an IP
     for counter in range(try_count):
-        #get an IP
-        theIP  = ipgetter.myipAndSource()
+        #get an IP (only the first try may reuse a cached answer)
+        theIP  = getter.get_externalip_and_source(use_cache = (counter == 0))
         
         #check to see that it has a ###.###.###.### format
         if  not (is_valid_ip(theIP["ip"])):
@@ -399,7 +428,7 @@ def doTheWork(config):
     #print ("Old IP = %s" % oldip)
 
     #get current, external, IP address
-    currip = getipAndSource(int(config.try_count), config.ip_blacklist)
+    currip = getipAndSource(int(config.try_count), config.ip_blacklist, int(config.lookup_cache_ttl), int(config.server_rate_limit), config.lookup_cache_path or None)
     #print ("Curr IP = %s" % currip["ip"])
 
     #check to see if the IP address has changed